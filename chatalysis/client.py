@@ -0,0 +1,118 @@
+"""
+Client for a running `chatalysis serve`, letting CLI commands skip loading the corpus.
+"""
+
+import json
+import socket
+import logging
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import urlencode
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from .load import cache_location
+
+logger = logging.getLogger(__name__)
+
+# Timeout for checking whether the server is up, answering a query may take a lot longer
+connect_timeout = 1
+query_timeout = 300
+
+
+def _server_file() -> Path:
+    # Written by a running server, so that clients can find it
+    return Path(cache_location) / "server.json"
+
+
+def _server_url() -> Optional[str]:
+    """Returns the URL of the running server, or None if there is none."""
+    path = _server_file()
+    try:
+        server = json.loads(path.read_text())
+        host, port = server["host"], server["port"]
+        socket.create_connection((host, port), timeout=connect_timeout).close()
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        # ValueError includes JSONDecodeError, for a partially written server file
+        logger.warning(f"No server reachable, computing locally: {e}")
+        return None
+    if ":" in host:
+        # IPv6 addresses need brackets in URLs
+        host = f"[{host}]"
+    return f"http://{host}:{port}"
+
+
+def _get(url: str, endpoint: str, params: dict) -> dict:
+    # drop unset params, and expand tuples into repeated params
+    query = urlencode(
+        [
+            (k, v)
+            for k, vs in params.items()
+            for v in (vs if isinstance(vs, (list, tuple)) else [vs])
+            if v is not None
+        ]
+    )
+    with urlopen(f"{url}/{endpoint}?{query}", timeout=query_timeout) as resp:
+        return json.load(resp)
+
+
+def _query_server(endpoint: str, **params) -> Optional[dict]:
+    """
+    Queries a running server, returning None if there is none (or the query failed),
+    in which case the caller should compute the result itself.
+    """
+    url = _server_url()
+    if url is None:
+        return None
+    try:
+        result = _get(url, endpoint, params)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Query to server failed, computing locally: {e}")
+        return None
+    logger.info(f"Got result for {endpoint} from server at {url}")
+    return result
+
+
+def _query_server_pages(endpoint: str, **params) -> Optional[Iterator[dict]]:
+    """
+    Like `_query_server`, but for paginated endpoints: returns an iterator over all pages,
+    following `next_offset` until exhausted.
+
+    Raises ConnectionError if the server fails after the first page (or the corpus was
+    reloaded in between), since part of the result has then already been consumed.
+    """
+    first = _query_server(endpoint, **params)
+    if first is None:
+        return None
+
+    def pages(page: dict) -> Iterator[dict]:
+        url = _server_url()
+        while True:
+            yield page
+            if page.get("next_offset") is None:
+                return
+            try:
+                if url is None:
+                    raise ConnectionError("server went away")
+                # the generation makes the server refuse offsets from a reloaded corpus
+                page = _get(
+                    url,
+                    endpoint,
+                    {
+                        **params,
+                        "offset": page["next_offset"],
+                        "generation": page["generation"],
+                    },
+                )
+            except HTTPError as e:
+                if e.code == 409:
+                    raise ConnectionError(
+                        "Chat files changed while paging through results, try again"
+                    )
+                raise ConnectionError(f"Query to server failed while paging: {e}")
+            except (OSError, ValueError) as e:
+                raise ConnectionError(f"Query to server failed while paging: {e}")
+
+    return pages(first)
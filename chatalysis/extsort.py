@@ -0,0 +1,110 @@
+"""
+External k-way merge of already-sorted runs.
+
+Used to iterate over all messages in time order without holding them all in memory:
+each conversation is a sorted run, and runs are spilled to disk as they are produced.
+"""
+
+import heapq
+import pickle
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def _spill(run: Iterable[Any], path: Path) -> Path:
+    with open(path, "wb") as f:
+        for item in run:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path: Path) -> Iterator[Any]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _kway_merge(
+    runs: Iterable[Iterable[T]],
+    key: Callable[[T], Any],
+    max_in_memory: int = 1_000_000,
+    max_open: int = 128,
+) -> Iterator[T]:
+    """
+    Lazily merges already-sorted runs into a single sorted stream.
+
+    Runs are buffered in memory until they hold more than `max_in_memory` items in total,
+    after which the buffered runs are spilled to disk. With `max_in_memory=0` every run is
+    streamed straight to disk, so only the head of each run is resident while merging
+    (plus whatever the producer of a run holds while it is being spilled).
+    At most `max_open` spilled runs are read at once, spilled runs beyond that are first
+    merged into larger runs. Ties are yielded in the order of the runs they came from.
+    """
+    assert max_open >= 2
+    with TemporaryDirectory(prefix="chatalysis-") as tmpdir:
+        n_files = 0
+
+        def spill(run: Iterable[T]) -> Path:
+            nonlocal n_files
+            n_files += 1
+            return _spill(run, Path(tmpdir) / f"run_{n_files}.pickle")
+
+        buffered: list[list[T]] = []
+        n_buffered = 0
+        spilled: list[Path] = []
+        for run in runs:
+            if max_in_memory == 0:
+                spilled.append(spill(run))
+                continue
+            buffered.append(list(run))
+            n_buffered += len(buffered[-1])
+            if n_buffered > max_in_memory:
+                logger.debug(f"Spilling {n_buffered} items to disk")
+                spilled.extend(spill(r) for r in buffered)
+                buffered = []
+                n_buffered = 0
+
+        # merge spilled runs in passes, to keep the number of open files bounded
+        while len(spilled) + bool(buffered) > max_open:
+            groups = [
+                spilled[i : i + max_open] for i in range(0, len(spilled), max_open)
+            ]
+            spilled = []
+            for group in groups:
+                spilled.append(
+                    spill(heapq.merge(*(_read_run(p) for p in group), key=key))
+                )
+                for p in group:
+                    p.unlink()
+
+        # spilled runs always precede the buffered ones
+        yield from heapq.merge(
+            *(_read_run(p) for p in spilled),
+            *buffered,
+            key=key,
+        )
+
+
+def test_kway_merge_in_memory():
+    runs = [[1, 4, 7], [2, 5], [], [3, 6, 8]]
+    assert list(_kway_merge(runs, key=lambda x: x)) == list(range(1, 9))
+
+
+def test_kway_merge_spill():
+    runs = [list(range(i, 100, 7)) for i in range(7)]
+    # forces every run to be spilled, and multiple merge passes
+    merged = _kway_merge(iter(runs), key=lambda x: x, max_in_memory=5, max_open=3)
+    assert list(merged) == list(range(100))
+
+    # spill each run as it is produced, without buffering
+    merged = _kway_merge(iter(runs), key=lambda x: x, max_in_memory=0, max_open=3)
+    assert list(merged) == list(range(100))
@@ -0,0 +1,223 @@
+"""
+Extraction and aggregation of links shared in conversations.
+
+Links are extracted per chat file (from both Share messages and URLs in message text),
+and the results are cached per file (see `_cache_by_file`).
+"""
+
+import re
+import logging
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Counter as TCounter
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .models import Message, Link
+from .load import _cache_by_file, _parse_chatfile, _get_all_chat_files
+
+logger = logging.getLogger(__name__)
+
+re_url = re.compile(r"https?://[^\s<>\"']+", re.IGNORECASE)
+
+# Trailing characters which are more likely punctuation than part of the URL
+_trailing_punct = ".,;:!?'\""
+
+# Closing brackets are only stripped if unbalanced, to keep e.g. `.../wiki/Foo_(bar)` intact
+_brackets = {")": "(", "]": "[", "}": "{"}
+
+# Query parameters used for tracking, dropped during normalization
+_tracking_params = {"fbclid", "gclid", "igshid", "si", "feature"}
+
+# Common multi-label public suffixes, so that e.g. `bbc.co.uk` is grouped as such.
+# Not exhaustive (that would require the full Public Suffix List), but covers most links.
+_multi_label_suffixes = {
+    "co.uk",
+    "org.uk",
+    "ac.uk",
+    "gov.uk",
+    "com.au",
+    "net.au",
+    "org.au",
+    "co.nz",
+    "co.jp",
+    "co.in",
+    "co.za",
+    "com.br",
+    "com.cn",
+    "com.mx",
+    "com.tr",
+}
+
+# Domains which are just redirects to the actual link, as found in Facebook exports
+_redirect_hosts = {"l.facebook.com", "lm.facebook.com", "l.messenger.com"}
+
+
+def _strip_trailing_punct(url: str) -> str:
+    while url:
+        last = url[-1]
+        if last in _trailing_punct:
+            url = url[:-1]
+        elif last in _brackets and url.count(_brackets[last]) < url.count(last):
+            url = url[:-1]
+        else:
+            break
+    return url
+
+
+def _find_urls(text: str) -> list[str]:
+    return [_strip_trailing_punct(url) for url in re_url.findall(text)]
+
+
+def _normalize_url(url: str) -> Optional[str]:
+    """Normalizes a URL: unwraps redirects, lowercases the host, drops fragments and tracking params."""
+    try:
+        parts = urlsplit(url.strip())
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        # e.g. non-numeric ports like `http://localhost:PORT/`
+        return None
+    if not host:
+        return None
+
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if host in _redirect_hosts:
+        target = dict(query).get("u")
+        return _normalize_url(target) if target else None
+
+    query = [
+        (k, v)
+        for k, v in query
+        if not k.lower().startswith("utm_") and k.lower() not in _tracking_params
+    ]
+    netloc = host if port is None else f"{host}:{port}"
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), netloc, path, urlencode(query), ""))
+
+
+def _registered_domain(url: str) -> str:
+    """Returns the registered domain of a URL, e.g. `https://m.youtube.com/...` -> `youtube.com`"""
+    host = (urlsplit(url).hostname or "").lower()
+    labels = host.split(".")
+    if len(labels) <= 2 or all(label.isdigit() for label in labels):
+        return host
+    n = 3 if ".".join(labels[-2:]) in _multi_label_suffixes else 2
+    return ".".join(labels[-n:])
+
+
+def test_normalize_url():
+    assert (
+        _normalize_url("HTTPS://WWW.Example.com/a/?utm_source=x&id=1#top")
+        == "https://www.example.com/a?id=1"
+    )
+    assert (
+        _normalize_url(
+            "https://l.facebook.com/l.php?u=https%3A%2F%2Fexample.org%2F%3Ffbclid%3Dabc&h=AT0"
+        )
+        == "https://example.org/"
+    )
+    assert _normalize_url("not a url") is None
+    assert _normalize_url("http://localhost:PORT/x") is None
+    assert _normalize_url("http://localhost:8080/x") == "http://localhost:8080/x"
+
+
+def test_registered_domain():
+    assert _registered_domain("https://m.youtube.com/watch?v=1") == "youtube.com"
+    assert _registered_domain("https://www.bbc.co.uk/news") == "bbc.co.uk"
+    assert _registered_domain("https://example.com/") == "example.com"
+    assert _registered_domain("http://127.0.0.1:8000/") == "127.0.0.1"
+
+
+def _extract_links(msgs: Iterable[Message], conversation: str) -> Iterator[Link]:
+    for msg in msgs:
+        # Share messages have the link as their content, so this covers them too
+        for url in _find_urls(msg.content):
+            normalized = _normalize_url(url)
+            if normalized is None:
+                continue
+            yield Link(
+                msg.from_name,
+                conversation,
+                msg.timestamp,
+                normalized,
+                _registered_domain(normalized),
+            )
+
+
+def test_extract_links():
+    from datetime import datetime
+
+    msgs = [
+        Message("A", "B", datetime(2020, 1, 1), "https://www.youtube.com/watch?v=1"),
+        Message("B", "A", datetime(2021, 1, 1), "see (https://github.com/x/y), and"),
+        Message("B", "A", datetime(2021, 1, 1), "no links here"),
+    ]
+    links = list(_extract_links(msgs, "A"))
+    assert [link.domain for link in links] == ["youtube.com", "github.com"]
+    assert links[1].url == "https://github.com/x/y"
+
+
+def test_find_urls():
+    assert _find_urls("see https://en.wikipedia.org/wiki/Foo_(bar).") == [
+        "https://en.wikipedia.org/wiki/Foo_(bar)"
+    ]
+    assert _find_urls("(https://example.com/a), [https://example.com/b]") == [
+        "https://example.com/a",
+        "https://example.com/b",
+    ]
+
+
+@_cache_by_file
+def _chatfile_links(filename: Path) -> list[Link]:
+    convo = _parse_chatfile(filename)
+    return list(_extract_links(convo.messages, convo.title))
+
+
+def _load_links(glob: str = "*") -> Iterator[Link]:
+    """Streams links from all chat files, one file at a time."""
+    logger.info("Loading links...")
+    for chatfile in _get_all_chat_files():
+        links = _chatfile_links(chatfile)
+        if glob != "*":
+            links = [
+                link for link in links if glob.lower() in link.conversation.lower()
+            ]
+        yield from links
+
+
+class LinkStats:
+    """Domain counts grouped by person, conversation, and year, built in a single pass."""
+
+    def __init__(self) -> None:
+        self.total: TCounter[str] = Counter()
+        self.by_person: dict[str, TCounter[str]] = defaultdict(Counter)
+        self.by_convo: dict[str, TCounter[str]] = defaultdict(Counter)
+        self.by_year: dict[int, TCounter[str]] = defaultdict(Counter)
+
+    def add(self, link: Link) -> None:
+        self.total[link.domain] += 1
+        self.by_person[link.from_name][link.domain] += 1
+        self.by_convo[link.conversation][link.domain] += 1
+        self.by_year[link.timestamp.year][link.domain] += 1
+
+    @classmethod
+    def from_links(cls, links: Iterable[Link]) -> "LinkStats":
+        stats = cls()
+        for link in links:
+            stats.add(link)
+        return stats
+
+
+def test_link_stats():
+    from datetime import datetime
+
+    links = [
+        Link("A", "AB", datetime(2020, 1, 1), "https://a.com/", "a.com"),
+        Link("A", "AB", datetime(2021, 1, 1), "https://a.com/x", "a.com"),
+        Link("B", "AB", datetime(2021, 1, 1), "https://b.com/", "b.com"),
+    ]
+    stats = LinkStats.from_links(links)
+    assert stats.total == {"a.com": 2, "b.com": 1}
+    assert stats.by_person["A"] == {"a.com": 2}
+    assert stats.by_year[2021] == {"a.com": 1, "b.com": 1}
+    assert stats.by_convo["AB"].most_common(1) == [("a.com", 2)]
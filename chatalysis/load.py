@@ -1,12 +1,18 @@
+import os
 import json
+import inspect
+import hashlib
 import logging
+import functools
+import threading
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
+from typing import Any, Callable, Optional, Iterator, TypeVar
 
-from joblib import Memory
+from joblib import Memory, dump, load
 
 from .models import Message, Conversation
+from .extsort import _kway_merge
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +22,56 @@ memory = Memory(cache_location, verbose=0)
 # TODO: Remove this constant, make configurable
 ME = "Erik Bjäreholt"
 
+T = TypeVar("T")
+
+
+def _cache_by_file(func: Callable[[Path], T]) -> Callable[[Path], T]:
+    """
+    Caches the result of a function of a file on disk, keyed on the file path.
+
+    The file's modification time (and a hash of the function's source) is stored along
+    with the result and checked on load, and a stale entry is overwritten when recomputed,
+    so the cache holds at most one entry per file.
+    """
+    try:
+        source = inspect.getsource(func)
+    except OSError:
+        source = func.__qualname__
+    version = hashlib.sha1(source.encode()).hexdigest()
+
+    @functools.wraps(func)
+    def wrapper(filename: Path) -> T:
+        mtime = Path(filename).stat().st_mtime
+        key = hashlib.sha1(str(filename).encode()).hexdigest()
+        path = Path(cache_location) / "files" / func.__qualname__ / f"{key}.pkl"
+        try:
+            cached: Any = load(path)
+            if cached["mtime"] == mtime and cached["version"] == version:
+                return cached["value"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(
+                f"Failed to load cached {func.__qualname__}, recomputing: {e}"
+            )
+
+        value = func(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so concurrent readers never see a partial entry
+        tmppath = path.with_name(
+            f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        dump({"mtime": mtime, "version": version, "value": value}, tmppath)
+        os.replace(tmppath, path)
+        return value
+
+    return wrapper
+
 
 def _get_all_conv_dirs():
     msgdir = Path("data/private/messages/inbox")
-    return [path.parent for path in msgdir.glob("*/message_1.json")]
+    # sorted, so that results with ties come out the same on every run
+    return sorted(path.parent for path in msgdir.glob("*/message_1.json"))
 
 
 def _load_convo(convdir: Path) -> Conversation:
@@ -34,23 +86,25 @@ def _load_convo(convdir: Path) -> Conversation:
     return convo
 
 
-def _load_convos(glob="*"):
+def _iter_convos(glob="*") -> Iterator[Conversation]:
     logger.info("Loading conversations...")
-    convos = [_load_convo(convdir) for convdir in _get_all_conv_dirs()]
-    if glob != "*":
-        convos = [convo for convo in convos if glob.lower() in convo.title.lower()]
-    return convos
+    for convdir in _get_all_conv_dirs():
+        convo = _load_convo(convdir)
+        if glob == "*" or glob.lower() in convo.title.lower():
+            yield convo
+
+
+def _load_convos(glob="*") -> list[Conversation]:
+    return list(_iter_convos(glob))
 
 
 def _get_all_chat_files(glob="*"):
     msgdir = Path("data/private/messages/inbox")
-    return sorted(
-        [
-            chatfile
-            for convdir in _get_all_conv_dirs()
-            for chatfile in msgdir.glob(f"{glob}/message*.json")
-        ]
-    )
+    return sorted(msgdir.glob(f"{glob}/message_*.json"))
+
+
+def _chatfile_mtimes() -> dict[str, float]:
+    return {str(path): path.stat().st_mtime for path in _get_all_chat_files()}
 
 
 def _list_all_chats():
@@ -66,6 +120,21 @@ def _load_all_messages(glob: str = "*") -> list[Message]:
     return messages
 
 
+def _iter_messages_sorted(glob: str = "*", max_in_memory: int = 0) -> Iterator[Message]:
+    """
+    Iterates over all messages in time order.
+
+    Conversations are loaded one at a time and spilled to disk, so at most one
+    conversation plus one message per conversation is held in memory. Raising
+    `max_in_memory` buffers up to that many messages before spilling (see `_kway_merge`).
+    """
+    return _kway_merge(
+        (convo.messages for convo in _iter_convos(glob)),
+        key=lambda m: m.timestamp,
+        max_in_memory=max_in_memory,
+    )
+
+
 def _parse_message(msg: dict, is_groupchat: bool, title: str) -> Optional[Message]:
     _type = msg.pop("type")
     if _type == "Subscribe":
@@ -145,8 +214,8 @@ def test_parse_message_share():
     assert resmsg.content == url
 
 
-@memory.cache
-def _parse_chatfile(filename: str) -> Conversation:
+@_cache_by_file
+def _parse_chatfile(filename: Path) -> Conversation:
     # FIXME: This should open all `message_*.json` files and merge into a single convo
     messages = []
     with open(filename) as f:
@@ -169,6 +238,30 @@ def _parse_chatfile(filename: str) -> Conversation:
     return Conversation(
         title=title,
         participants=participants,
-        messages=messages,
+        # exports are usually newest-first, so this is cheap
+        messages=sorted(messages, key=lambda m: m.timestamp),
         data={"groupchat": is_groupchat},
     )
+
+
+def test_cache_by_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(__name__ + ".cache_location", str(tmp_path / "cache"))
+    calls = []
+
+    @_cache_by_file
+    def _read(filename: Path) -> str:
+        calls.append(filename)
+        return filename.read_text()
+
+    file = tmp_path / "message_1.json"
+    file.write_text("a")
+    assert _read(file) == "a"
+    assert _read(file) == "a"
+    assert len(calls) == 1
+
+    # a changed file is recomputed, replacing the stale entry
+    file.write_text("b")
+    os.utime(file, (0, 1))
+    assert _read(file) == "b"
+    assert len(calls) == 2
+    assert len(list((tmp_path / "cache").glob("files/*/*.pkl"))) == 1
@@ -2,21 +2,37 @@ import logging
 import textwrap
 
 from collections import defaultdict
-from typing import List, Any, Tuple, Dict
+from datetime import datetime
+from typing import (
+    List,
+    Any,
+    Tuple,
+    Dict,
+    Sequence,
+    Iterable,
+    Iterator,
+    Callable,
+    Optional,
+)
 from itertools import groupby
 
 import click
 from tabulate import tabulate
 
-from .models import Message, Writerstats
+from .models import Message, Writerstats, ConvoSummary
 from .util import (
     _calculate_streak,
     _format_emojicount,
+    _format_counts,
     _most_used_emoji,
     _convo_participants_key_undir,
     _filter_author,
 )
-from .load import _load_all_messages, _load_convos
+from .load import _load_all_messages, _iter_messages_sorted
+from .links import LinkStats, _load_links
+from .scoring import scorers, _aggregate_scores, _round_score
+from .summary import _load_summaries
+from .client import _query_server, _query_server_pages
 
 logger = logging.getLogger(__name__)
 
@@ -33,10 +49,13 @@ def main():
 @click.option("--user")
 def daily(glob: str, user: str = None) -> None:
     """Your messaging stats, by date"""
-    msgs = _load_all_messages(glob)
-    if user:
-        msgs = _filter_author(msgs, user)
-    _daily_messaging_stats(msgs)
+    table = _query_server("daily", glob=glob, user=user)
+    if table is None:
+        msgs = _iter_messages_sorted(glob)
+        if user:
+            msgs = _filter_author(msgs, user)
+        table = _daily_messaging_stats(msgs)
+    _print_messaging_stats(table)
 
 
 @main.command()
@@ -44,18 +63,33 @@ def daily(glob: str, user: str = None) -> None:
 @click.option("--user")
 def yearly(glob: str, user: str = None) -> None:
     """Your messaging stats, by year"""
-    msgs = _load_all_messages(glob)
-    if user:
-        msgs = _filter_author(msgs, user)
-    _yearly_messaging_stats(msgs)
+    table = _query_server("yearly", glob=glob, user=user)
+    if table is None:
+        msgs = _iter_messages_sorted(glob)
+        if user:
+            msgs = _filter_author(msgs, user)
+        table = _yearly_messaging_stats(msgs)
+    _print_messaging_stats(table)
+
+
+score_option = click.option(
+    "--score",
+    "scores",
+    multiple=True,
+    type=click.Choice(list(scorers)),
+    help="Add a column with the mean message score",
+)
 
 
 @main.command()
 @click.argument("glob", default="*")
-def top_writers(glob: str) -> None:
+@score_option
+def top_writers(glob: str, scores: tuple[str, ...] = ()) -> None:
     """List the top writers"""
-    msgs = _load_all_messages(glob)
-    _top_writers(msgs)
+    table = _query_server("top-writers", glob=glob, score=scores)
+    if table is None:
+        table = _top_writers(_load_all_messages(glob), scores)
+    _print_table(table)
 
 
 @main.command()
@@ -63,34 +97,57 @@ def top_writers(glob: str) -> None:
 @click.option("--contains")
 def messages(user: str = None, contains: str = None) -> None:
     """List messages, filter by user or content."""
-    msgs = _load_all_messages()
-    if user:
-        msgs = [msg for msg in msgs if user.lower() in msg.from_name.lower()]
-    if contains:
-        msgs = [msg for msg in msgs if contains.lower() in msg.content.lower()]
-    msgs = sorted(msgs, key=lambda m: m.timestamp)
-    for msg in msgs:
-        msg.print()
+    pages = _query_server_pages("messages", user=user, contains=contains)
+    if pages is not None:
+        msgs: Iterable[Message] = (
+            Message.from_dict(d) for page in pages for d in page["messages"]
+        )
+    else:
+        msgs = _search_messages(_iter_messages_sorted(), user, contains)
+    try:
+        for msg in msgs:
+            msg.print()
+    except ConnectionError as e:
+        raise click.ClickException(str(e))
+
+
+def _message_matches(
+    msg: Message, user: Optional[str] = None, contains: Optional[str] = None
+) -> bool:
+    if user and user.lower() not in msg.from_name.lower():
+        return False
+    if contains and contains.lower() not in msg.content.lower():
+        return False
+    return True
+
+
+def _search_messages(
+    msgs: Iterable[Message], user: Optional[str] = None, contains: Optional[str] = None
+) -> Iterator[Message]:
+    return (msg for msg in msgs if _message_matches(msg, user, contains))
 
 
 @main.command()
-def people() -> None:
+@score_option
+def people(scores: tuple[str, ...] = ()) -> None:
     """List all people"""
-    msgs = _load_all_messages()
-    _people_stats(msgs)
+    table = _query_server("people", score=scores)
+    if table is None:
+        table = _people_stats(_load_all_messages(), scores)
+    _print_table(table)
 
 
 @main.command()
 @click.argument("glob", default="*")
 def convos(glob: str) -> None:
     """List all conversations (groups and 1-1s)"""
-    convos = _load_convos(glob)
+    summaries = _load_summaries(glob)
 
     data = []
     wrapper = textwrap.TextWrapper(max_lines=1, width=30, placeholder="...")
-    for convo in convos:
+    for summary in summaries:
         data.append(
-            (wrapper.fill(convo.title), len(convo.participants), len(convo.messages))
+            (wrapper.fill(summary.title), len(summary.participants), summary.n_messages)
         )
     data = sorted(data, key=lambda t: t[2])
     print(tabulate(data, headers=["name", "members", "messages"]))
@@ -100,8 +157,13 @@ def convos(glob: str) -> None:
 @click.argument("glob", default="*")
 def most_reacted(glob: str) -> None:
     """List the most reacted messages"""
-    msgs = _load_all_messages(glob)
-    _most_reacted_msgs(msgs)
+    res = _query_server("most-reacted", glob=glob)
+    if res is not None:
+        msgs = [Message.from_dict(d) for d in res["messages"]]
+    else:
+        msgs = _most_reacted_msgs(_load_all_messages(glob))
+    for msg in msgs:
+        msg.print()
 
 
 @main.command()
@@ -112,27 +174,20 @@ def creeps(glob: str) -> None:
 
     Note: this is perhaps easier using same output as from top-writers, but taking the bottom instead
     """
-    convos = _load_convos(glob)
-
-    for convo in convos:
-        if not convo.data["groupchat"]:
+    for summary in _load_summaries(glob):
+        if not summary.groupchat:
             continue
 
-        messages_by_user: dict[str, int] = defaultdict(int)
-        reacts_by_user: dict[str, int] = defaultdict(int)
-        for message in convo.messages:
-            messages_by_user[message.from_name] += 1
-            for react in message.reactions:
-                actor = react["actor"]
-                reacts_by_user[actor] += 1
+        messages_by_user = summary.messages_by_user
+        reacts_by_user = summary.reacts_by_user
 
-        fullcreeps = set(convo.participants) - (
+        fullcreeps = set(summary.participants) - (
             set(messages_by_user.keys()) | set(reacts_by_user.keys())
         )
 
         # includes participants who've left the chat
-        all_participants = set(convo.participants) | set(messages_by_user.keys())
-        print(f"# {convo.title}\n")
+        all_participants = set(summary.participants) | set(messages_by_user.keys())
+        print(f"# {summary.title}\n")
         stats = [
             (part, messages_by_user[part], reacts_by_user[part])
             for part in all_participants
@@ -149,55 +204,167 @@ def creeps(glob: str) -> None:
         print()
 
 
-def _most_reacted_msgs(msgs):
-    msgs = filter(lambda m: m.reactions, msgs)
-    msgs = sorted(msgs, key=lambda m: -len(m.reactions))
-    for msg in msgs[:30]:
-        msg.print()
+@main.command()
+@click.argument("glob", default="*")
+@click.option("--by", type=click.Choice(["person", "convo", "year"]))
+@click.option("--top", default=10, help="Number of domains to list")
+def links(glob: str, by: Optional[str] = None, top: int = 10) -> None:
+    """List the most linked domains, optionally by person, conversation, or year"""
+    stats = LinkStats.from_links(_load_links(glob))
+    _link_stats(stats, by, top)
+
+
+def _link_stats(stats: LinkStats, by: Optional[str] = None, top: int = 10) -> None:
+    print(f"All-time links shared: {sum(stats.total.values())}")
+    if by is None:
+        print(tabulate(stats.total.most_common(top), headers=["domain", "links"]))
+        return
+
+    groupings: dict[str, dict] = {
+        "person": stats.by_person,
+        "convo": stats.by_convo,
+        "year": stats.by_year,
+    }
+    groups = groupings[by]
+    wrapper = textwrap.TextWrapper(max_lines=1, width=30, placeholder="...")
+    rows = [
+        (
+            wrapper.fill(str(k)),
+            sum(domains.values()),
+            _format_counts(dict(domains.most_common(top))),
+        )
+        for k, domains in groups.items()
+    ]
+    # sort years chronologically, everything else by number of links
+    if by == "year":
+        rows = sorted(rows, key=lambda t: t[0])
+    else:
+        rows = sorted(rows, key=lambda t: t[1], reverse=True)
+    print(tabulate(rows, headers=[by, "links", "top domains"]))
 
 
-def _yearly_messaging_stats(msgs: list[Message]):
-    print(f"All-time messages sent: {len(msgs)}")
+convo_rankings: dict[str, Callable[[ConvoSummary], Any]] = {
+    "messages": lambda s: s.n_messages,
+    "reacts": lambda s: s.n_reacts,
+    "members": lambda s: len(s.participants),
+    "days": lambda s: len(s.days),
+    "streak": lambda s: _calculate_streak(s.days),
+    "msgs-per-day": lambda s: s.n_messages / len(s.days) if s.days else 0,
+    "recent": lambda s: s.last or datetime.min,
+}
 
-    msgs_by_date = defaultdict(list)
-    for msg in msgs:
-        msgs_by_date[msg.timestamp.year].append(msg)
 
-    rows = []
-    for year, msgs in sorted(msgs_by_date.items()):
-        if not msgs:
-            continue
-        rows.append(
-            (
-                year,
-                len(msgs),
-                sum(len(m.content.split(" ")) for m in msgs),  # words
-                sum(len(m.content) for m in msgs),  # chars
-            )
+@main.command()
+@click.argument("glob", default="*")
+@click.option("--by", type=click.Choice(list(convo_rankings)), default="messages")
+@click.option("--limit", default=30, help="Number of conversations to list")
+@click.option("--groups/--no-groups", default=None, help="Only/no group chats")
+def top_convos(glob: str, by: str, limit: int, groups: Optional[bool] = None) -> None:
+    """Rank conversations by activity"""
+    summaries = _load_summaries(glob)
+    if groups is not None:
+        summaries = (s for s in summaries if s.groupchat == groups)
+    _top_convos(summaries, by, limit)
+
+
+def _top_convos(summaries: Iterable[ConvoSummary], by: str, limit: int) -> None:
+    ranked = sorted(summaries, key=convo_rankings[by], reverse=True)[:limit]
+    wrapper = textwrap.TextWrapper(max_lines=1, width=30, placeholder="...")
+    print(
+        tabulate(
+            [
+                (
+                    wrapper.fill(s.title),
+                    len(s.participants),
+                    s.n_messages,
+                    s.n_reacts,
+                    len(s.days),
+                    _calculate_streak(s.days),
+                    s.first.date() if s.first else None,
+                    s.last.date() if s.last else None,
+                )
+                for s in ranked
+            ],
+            headers=[
+                "name",
+                "members",
+                "messages",
+                "reacts",
+                "days",
+                "max streak",
+                "first",
+                "last",
+            ],
         )
-    print(tabulate(rows, headers=["year", "# msgs", "words", "chars"]))
+    )
 
 
-def _daily_messaging_stats(msgs: list[Message]):
-    print(f"All-time messages sent: {len(msgs)}")
+def _most_reacted_msgs(msgs: Iterable[Message], limit: int = 30) -> list[Message]:
+    msgs = filter(lambda m: m.reactions, msgs)
+    return sorted(msgs, key=lambda m: (-len(m.reactions), m.timestamp))[:limit]
 
-    msgs_by_date = defaultdict(list)
-    for msg in msgs:
-        msgs_by_date[msg.timestamp.date()].append(msg)
 
+def test_ordering_ties():
+    from datetime import datetime
+
+    react = {"reaction": "👍", "actor": "C"}
+    msgs = [
+        Message("B", "A", datetime(2020, 1, 2), "later", reactions=[react]),
+        Message("A", "B", datetime(2020, 1, 1), "earlier", reactions=[react]),
+    ]
+    # ties are broken the same way regardless of input order
+    for order in (msgs, msgs[::-1]):
+        assert [m.content for m in _most_reacted_msgs(order)] == ["earlier", "later"]
+        writers = [row[0] for row in _top_writers(order)["rows"]]
+        assert writers == ["A", "B", "C"]
+
+
+def _print_table(table: dict) -> None:
+    print(tabulate(table["rows"], headers=table["headers"]))
+
+
+def _yearly_messaging_stats(msgs: Iterable[Message]) -> dict:
+    rows = _messaging_stats_rows(msgs, key=lambda m: m.timestamp.year)
+    return {"headers": ["year", "# msgs", "words", "chars"], "rows": rows}
+
+
+def _daily_messaging_stats(msgs: Iterable[Message]) -> dict:
+    rows = _messaging_stats_rows(msgs, key=lambda m: m.timestamp.date())
+    return {"headers": ["date", "# msgs", "words", "chars"], "rows": rows}
+
+
+def _print_messaging_stats(table: dict) -> None:
+    print(f"All-time messages sent: {sum(row[1] for row in table['rows'])}")
+    _print_table(table)
+
+
+def _messaging_stats_rows(
+    msgs: Iterable[Message], key: Callable[[Message], Any]
+) -> list[tuple[Any, int, int, int]]:
+    # msgs must be time-ordered, so that each period is a single group
     rows = []
-    for d, msgs in sorted(msgs_by_date.items()):
-        if not msgs:
-            continue
-        rows.append(
-            (
-                d,
-                len(msgs),
-                sum(len(m.content.split(" ")) for m in msgs),  # words
-                sum(len(m.content) for m in msgs),  # chars
-            )
-        )
-    print(tabulate(rows, headers=["year", "# msgs", "words", "chars"]))
+    for period, group in groupby(msgs, key=key):
+        n = words = chars = 0
+        for m in group:
+            n += 1
+            words += len(m.content.split(" "))
+            chars += len(m.content)
+        rows.append((period, n, words, chars))
+    return rows
+
+
+def test_messaging_stats_rows():
+    from datetime import datetime
+
+    msgs = [
+        Message("A", "B", datetime(2020, 1, 1, 10), "hello there"),
+        Message("B", "A", datetime(2020, 1, 1, 11), "hi"),
+        Message("A", "B", datetime(2021, 3, 1), "yo"),
+    ]
+    assert _messaging_stats_rows(msgs, key=lambda m: m.timestamp.year) == [
+        (2020, 2, 3, 13),
+        (2021, 1, 1, 2),
+    ]
 
 
 def _writerstats(msgs: list[Message]) -> dict[str, Writerstats]:
@@ -217,43 +384,47 @@ def _writerstats(msgs: list[Message]) -> dict[str, Writerstats]:
     return writerstats
 
 
-def _top_writers(msgs: list[Message]):
+def _top_writers(msgs: list[Message], scores: Sequence[str] = ()) -> dict:
     writerstats = _writerstats(msgs)
-    writerstats = dict(
-        sorted(writerstats.items(), key=lambda kv: kv[1].msgs, reverse=True)
-    )
+    writerscores = _aggregate_scores(msgs, scores, key=lambda m: m.from_name)
+    writerstats = dict(sorted(writerstats.items(), key=lambda kv: (-kv[1].msgs, kv[0])))
 
     wrapper = textwrap.TextWrapper(max_lines=1, width=30, placeholder="...")
-    print(
-        tabulate(
-            [
-                (
-                    wrapper.fill(writer),
-                    stats.msgs,
-                    len(stats.days),
-                    stats.words,
-                    stats.reacts_sent,
-                    stats.reacts_recv,
-                    round(
-                        1000 * (stats.reacts_recv / stats.words) if stats.words else 0,
-                    ),
-                )
-                for writer, stats in writerstats.items()
-            ],
-            headers=[
-                "name",
-                "msgs",
-                "days",
-                "words",
-                "reacts sent",
-                "reacts recv",
-                "reacts/1k words",
-            ],
-        )
-    )
-
-
-def _people_stats(msgs: List[Message]) -> None:
+    return {
+        "rows": [
+            (
+                wrapper.fill(writer),
+                stats.msgs,
+                len(stats.days),
+                stats.words,
+                stats.reacts_sent,
+                stats.reacts_recv,
+                round(
+                    1000 * (stats.reacts_recv / stats.words) if stats.words else 0,
+                ),
+            )
+            + tuple(
+                # writers who've only reacted have no score, which is left blank
+                _round_score(writerscores[name].get(writer))
+                for name in scores
+            )
+            for writer, stats in writerstats.items()
+        ],
+        "headers": [
+            "name",
+            "msgs",
+            "days",
+            "words",
+            "reacts sent",
+            "reacts recv",
+            "reacts/1k words",
+            *scores,
+        ],
+    }
+
+
+def _people_stats(msgs: List[Message], scores: Sequence[str] = ()) -> dict:
+    convoscores = _aggregate_scores(msgs, scores, key=_convo_participants_key_undir)
     grouped = groupby(
         sorted(msgs, key=_convo_participants_key_undir),
         key=_convo_participants_key_undir,
@@ -272,8 +443,12 @@ def _people_stats(msgs: List[Message]) -> None:
                     dict(_most_used_emoji(m.content for m in v).most_common()[:5])
                 ),
             )
+            + tuple(_round_score(convoscores[name][k]) for name in scores)
         )
-    print(tabulate(rows, headers=["k", "days", "max streak", "most used emoji"]))
+    return {
+        "headers": ["k", "msgs", "days", "max streak", "most used emoji", *scores],
+        "rows": rows,
+    }
 
 
 def _connections(msgs: List[Message]) -> Dict[Tuple[str, str], int]:
@@ -292,14 +467,43 @@ def connections(csv: bool) -> None:
     List all connections between interacting people, assigning weights as per the number of messages they have exchanged.
     """
     # TODO: Also count reply-messages and immediately-following messages in groupchats
-    msgs = _load_all_messages()
-    connections = _connections(msgs)
+    table = _query_server("connections")
+    if table is None:
+        table = _connections_table(_connections(_load_all_messages()))
     if csv:
-        print(",".join(["from", "to", "count"]))
-        for k, v in sorted(connections.items(), key=lambda kv: kv[1], reverse=True):
-            print(",".join(map(str, k + (v,))))
+        print(",".join(table["headers"]))
+        for row in sorted(table["rows"], key=lambda row: row[2], reverse=True):
+            print(",".join(map(str, row)))
     else:
-        print(tabulate(sorted(connections.items()), headers=["from", "to", "count"]))
+        _print_table(table)
+
+
+def _connections_table(connections: Dict[Tuple[str, str], int]) -> dict:
+    return {
+        "headers": ["from", "to", "count"],
+        "rows": [k + (v,) for k, v in sorted(connections.items())],
+    }
+
+
+@main.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8042)
+@click.option("--cache-size", default=256, help="Number of query results to cache")
+@click.option(
+    "--allow-remote",
+    is_flag=True,
+    help="Allow binding to non-loopback addresses, exposing your messages to the network",
+)
+def serve(host: str, port: int, cache_size: int, allow_remote: bool) -> None:
+    """Serve queries over HTTP, keeping the corpus loaded"""
+    from .server import serve, _is_loopback
+
+    if not allow_remote and not _is_loopback(host):
+        raise click.BadParameter(
+            f"{host} is not a loopback address, pass --allow-remote to serve on it anyway",
+            param_hint="--host",
+        )
+    serve(host, port, cache_size, allow_remote=allow_remote)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
+import heapq
+from collections import Counter
 from datetime import datetime, date
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
+from typing import Optional, Counter as TCounter
 
 
 @dataclass
@@ -11,6 +14,15 @@ class Message:
     reactions: list[dict] = field(default_factory=list)
     data: dict = field(default_factory=dict)
 
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d["timestamp"] = self.timestamp.isoformat()
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Message":
+        return cls(**{**d, "timestamp": datetime.fromisoformat(d["timestamp"])})
+
     def print(self) -> None:
         from .util import _format_emojicount, _count_emoji
 
@@ -46,11 +58,52 @@ class Conversation:
         return Conversation(
             title=self.title,
             participants=self.participants,
-            messages=sorted(self.messages + c2.messages, key=lambda m: m.timestamp),
+            # both conversations are already sorted, so a linear merge suffices
+            messages=list(
+                heapq.merge(self.messages, c2.messages, key=lambda m: m.timestamp)
+            ),
             data=self.data,
         )
 
 
+@dataclass
+class ConvoSummary:
+    """Per-conversation aggregates, which can be used without loading message bodies."""
+
+    title: str
+    participants: list[str]
+    groupchat: bool
+    messages_by_user: TCounter[str] = field(default_factory=Counter)
+    reacts_by_user: TCounter[str] = field(default_factory=Counter)
+    days: set[date] = field(default_factory=set)
+    first: Optional[datetime] = None
+    last: Optional[datetime] = None
+
+    @property
+    def n_messages(self) -> int:
+        return sum(self.messages_by_user.values())
+
+    @property
+    def n_reacts(self) -> int:
+        return sum(self.reacts_by_user.values())
+
+    def merge(self, s2: "ConvoSummary") -> "ConvoSummary":
+        assert self.title == s2.title
+        assert self.participants == s2.participants
+        firsts = [t for t in (self.first, s2.first) if t is not None]
+        lasts = [t for t in (self.last, s2.last) if t is not None]
+        return ConvoSummary(
+            title=self.title,
+            participants=self.participants,
+            groupchat=self.groupchat,
+            messages_by_user=self.messages_by_user + s2.messages_by_user,
+            reacts_by_user=self.reacts_by_user + s2.reacts_by_user,
+            days=self.days | s2.days,
+            first=min(firsts, default=None),
+            last=max(lasts, default=None),
+        )
+
+
 @dataclass
 class Writerstats:
     days: set[date] = field(default_factory=set)
@@ -58,3 +111,12 @@ class Writerstats:
     words: int = 0
     reacts_recv: int = 0
     reacts_sent: int = 0
+
+
+@dataclass
+class Link:
+    from_name: str
+    conversation: str
+    timestamp: datetime
+    url: str
+    domain: str
@@ -0,0 +1,282 @@
+"""
+Per-message text scoring (sentiment etc.)
+
+Scores are computed in chunks across a process pool, and persisted keyed on message
+identity so that re-runs only need to score new messages.
+"""
+
+import os
+import re
+import logging
+import threading
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from joblib import dump, load
+
+from .models import Message
+from .load import cache_location
+from .util import _message_key
+
+logger = logging.getLogger(__name__)
+
+re_word = re.compile(r"[\w']+|[\U00002600-\U000027BF\U0001f300-\U0001f64F]")
+
+
+class Scorer(ABC):
+    """
+    Base class for message scorers.
+
+    Subclasses set `name`, and bump `version` whenever their output changes
+    (which invalidates previously persisted scores).
+    """
+
+    name: str
+    version: int = 1
+
+    @abstractmethod
+    def score(self, text: str) -> float: ...
+
+    def score_many(self, texts: list[str]) -> list[float]:
+        return [self.score(text) for text in texts]
+
+
+class LexiconSentiment(Scorer):
+    """
+    Offline lexicon-based sentiment, in the range [-1, 1].
+
+    Averages the valence of known words/emoji, flipping the valence of words directly following a negation.
+    """
+
+    name = "sentiment"
+
+    lexicon: dict[str, float] = {
+        # positive
+        "good": 2, "great": 3, "awesome": 4, "amazing": 4, "nice": 2, "cool": 1,
+        "love": 3, "loved": 3, "lovely": 3, "like": 1, "liked": 1, "happy": 3,
+        "glad": 2, "fun": 2, "funny": 2, "haha": 2, "hahaha": 2, "lol": 2,
+        "thanks": 2, "thank": 2, "best": 3, "better": 2, "excellent": 3,
+        "perfect": 3, "beautiful": 3, "congrats": 3, "congratulations": 3,
+        "yay": 3, "wow": 2, "win": 3, "excited": 3, "interesting": 2,
+        "agree": 1, "yes": 1, "sweet": 2, "enjoy": 2, "enjoyed": 2,
+        # negative
+        "bad": -2, "worse": -2, "worst": -3, "terrible": -3, "awful": -3,
+        "horrible": -3, "hate": -3, "hated": -3, "sad": -2, "angry": -3,
+        "annoying": -2, "annoyed": -2, "boring": -2, "sorry": -1, "sick": -2,
+        "tired": -1, "ugh": -2, "damn": -2, "wrong": -2, "fail": -2,
+        "failed": -2, "problem": -1, "stupid": -2, "sucks": -3, "cry": -2,
+        "worried": -2, "scared": -2, "disappointed": -2, "no": -1, "lost": -2,
+        # emoji
+        "😀": 2, "😁": 2, "😂": 2, "😃": 2, "😄": 2, "😊": 2, "😍": 3,
+        "😘": 2, "😋": 2, "👍": 2, "❤": 3, "🎉": 3,
+        "😞": -2, "😢": -2, "😭": -2, "😠": -3, "😡": -3, "👎": -2,
+    }  # fmt: skip
+
+    negations = {"not", "no", "never", "don't", "dont", "isn't", "wasn't", "can't"}
+
+    def score(self, text: str) -> float:
+        total = 0.0
+        n = 0
+        negate = False
+        for word in re_word.findall(text.lower()):
+            valence = self.lexicon.get(word)
+            if valence is not None:
+                total += -valence if negate else valence
+                n += 1
+            negate = word in self.negations
+        # normalize valence to [-1, 1]
+        return total / (4 * n) if n else 0.0
+
+
+def test_lexicon_sentiment():
+    scorer = LexiconSentiment()
+    assert scorer.score("this is great!") > 0
+    assert scorer.score("this is not great") < 0
+    assert scorer.score("terrible 😭") < 0
+    assert scorer.score("hello there") == 0
+    assert -1 <= scorer.score("awesome amazing") <= 1
+
+
+scorers: dict[str, Scorer] = {s.name: s for s in [LexiconSentiment()]}
+
+
+def _score_chunk(scorer: Scorer, texts: list[str]) -> list[float]:
+    return scorer.score_many(texts)
+
+
+def _shard_path(scorer: Scorer, shard: str) -> Path:
+    return (
+        Path(cache_location)
+        / "scores"
+        / f"{scorer.name}-v{scorer.version}"
+        / f"{shard}.pkl"
+    )
+
+
+def _shard(key: str) -> str:
+    # Scores are persisted in shards by key prefix, so that scoring a few new messages
+    # only rewrites the shards they fall in rather than every score ever computed.
+    return key[:2]
+
+
+# Guards the persisted scores when scoring from several threads (as under `serve`)
+_scores_lock = threading.Lock()
+
+
+def _load_shard(scorer: Scorer, shard: str) -> dict[str, float]:
+    path = _shard_path(scorer, shard)
+    if not path.exists():
+        return {}
+    try:
+        return load(path)
+    except Exception as e:
+        logger.warning(f"Failed to load persisted scores, rescoring: {e}")
+        return {}
+
+
+def _save_shard(scorer: Scorer, shard: str, scores: dict[str, float]) -> None:
+    path = _shard_path(scorer, shard)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so an interrupted write can't corrupt the scores
+    tmppath = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    dump(scores, tmppath)
+    os.replace(tmppath, path)
+
+
+def _score_messages(
+    msgs: Iterable[Message],
+    scorer: Scorer,
+    chunksize: int = 10_000,
+    processes: Optional[int] = None,
+) -> list[float]:
+    """
+    Returns scores for the messages, in order, only scoring messages missing from
+    the persisted scores.
+    """
+    with _scores_lock:
+        return _score_messages_locked(msgs, scorer, chunksize, processes)
+
+
+def _score_messages_locked(
+    msgs: Iterable[Message],
+    scorer: Scorer,
+    chunksize: int,
+    processes: Optional[int],
+) -> list[float]:
+    msgs = list(msgs)
+    keys = [_message_key(msg) for msg in msgs]
+    shards: dict[str, dict[str, float]] = {}
+    todo = {}
+    for key, msg in zip(keys, msgs):
+        shard = _shard(key)
+        if shard not in shards:
+            shards[shard] = _load_shard(scorer, shard)
+        if key not in shards[shard]:
+            todo[key] = msg.content
+
+    if todo:
+        logger.info(f"Scoring {len(todo)} new messages with {scorer.name}...")
+        new_keys = list(todo.keys())
+        texts = list(todo.values())
+        chunks = [texts[i : i + chunksize] for i in range(0, len(texts), chunksize)]
+        if (
+            len(chunks) == 1
+            or threading.current_thread() is not threading.main_thread()
+        ):
+            # not worth the overhead of starting a process pool, and forking from a
+            # worker thread (as under `serve`) risks deadlocks
+            results = [_score_chunk(scorer, chunk) for chunk in chunks]
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(processes, mp_context=ctx) as pool:
+                results = list(pool.map(_score_chunk, [scorer] * len(chunks), chunks))
+        changed = set()
+        for key, score in zip(new_keys, (s for chunk in results for s in chunk)):
+            shards[_shard(key)][key] = score
+            changed.add(_shard(key))
+        for shard in changed:
+            _save_shard(scorer, shard, shards[shard])
+
+    return [shards[_shard(key)][key] for key in keys]
+
+
+def _round_score(score: Optional[float]) -> Optional[float]:
+    return round(score, 3) if score is not None else None
+
+
+def _mean_scores(
+    msgs: Iterable[Message],
+    scores: Iterable[float],
+    key: Callable[[Message], str],
+) -> dict[str, float]:
+    """Averages message scores (in the same order as the messages), grouped by `key`"""
+    sums: dict[str, float] = defaultdict(float)
+    counts: dict[str, int] = defaultdict(int)
+    for msg, score in zip(msgs, scores):
+        k = key(msg)
+        sums[k] += score
+        counts[k] += 1
+    return {k: sums[k] / counts[k] for k in sums}
+
+
+def _aggregate_scores(
+    msgs: list[Message], names: Iterable[str], key: Callable[[Message], str]
+) -> dict[str, dict[str, float]]:
+    """Returns mean scores as `{scorer name: {group: mean score}}`"""
+    return {
+        name: _mean_scores(msgs, _score_messages(msgs, scorers[name]), key)
+        for name in names
+    }
+
+
+def test_score_messages(tmp_path, monkeypatch):
+    from datetime import datetime
+
+    monkeypatch.setattr(__name__ + ".cache_location", str(tmp_path))
+
+    scorer = LexiconSentiment()
+    msgs = [
+        Message("A", "B", datetime(2020, 1, 1), "great"),
+        Message("A", "B", datetime(2020, 1, 2), "awful"),
+        Message("B", "A", datetime(2020, 1, 3), "hi"),
+    ]
+    # chunksize=1 to score in a process pool
+    scores = _score_messages(msgs, scorer, chunksize=1)
+    assert scores == [scorer.score(msg.content) for msg in msgs]
+
+    scored: list[str] = []
+
+    def _record_chunk(scorer: Scorer, texts: list[str]) -> list[float]:
+        scored.extend(texts)
+        return scorer.score_many(texts)
+
+    monkeypatch.setattr(__name__ + "._score_chunk", _record_chunk)
+    msgs.append(Message("B", "A", datetime(2020, 1, 4), "good"))
+    scores = _score_messages(msgs, scorer)
+    assert scored == ["good"]  # only the new message was scored
+    assert len(scores) == 4
+    # only the shard holding the new message was written
+    shards = list((tmp_path / "scores" / "sentiment-v1").glob("*.pkl"))
+    assert 1 <= len(shards) <= 4
+
+    means = _mean_scores(msgs, scores, key=lambda m: m.from_name)
+    assert means["A"] == 0
+    assert means["B"] > 0
+
+    # corrupt persisted scores are recomputed rather than failing
+    shards[0].write_bytes(b"garbage")
+    assert _score_messages(msgs, scorer) == scores
+
+
+def test_scorer_abstract():
+    import pytest
+
+    class Incomplete(Scorer):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()  # type: ignore
@@ -0,0 +1,480 @@
+"""
+Local HTTP server, which keeps the corpus loaded and answers queries as JSON.
+
+Start with `chatalysis serve`, after which CLI commands will query the server instead of
+loading the corpus themselves (see `client._query_server`).
+"""
+
+import os
+import signal
+import json
+import heapq
+import asyncio
+import logging
+import ipaddress
+import threading
+from contextlib import suppress
+from functools import lru_cache
+from http import HTTPStatus
+from typing import Callable, Optional
+from urllib.parse import urlsplit, parse_qs
+
+from .models import Message, Conversation
+from .load import _load_convos, _chatfile_mtimes
+from .client import _server_file
+from .scoring import scorers
+from .util import _filter_author
+from .main import (
+    _daily_messaging_stats,
+    _yearly_messaging_stats,
+    _top_writers,
+    _people_stats,
+    _connections,
+    _connections_table,
+    _most_reacted_msgs,
+    _message_matches,
+)
+
+logger = logging.getLogger(__name__)
+
+Params = dict[str, list[str]]
+
+# Max number of messages returned per request by the paginated messages endpoint
+page_size = 1000
+
+# Host names accepted in the Host header (with the server's port), guarding against DNS
+# rebinding attacks where a website in the browser resolves its own name to 127.0.0.1
+_loopback_names = ("localhost", "127.0.0.1", "[::1]")
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _param(params: Params, key: str, default: Optional[str] = None) -> Optional[str]:
+    return params.get(key, [default])[-1]
+
+
+def _scores_param(params: Params) -> list[str]:
+    names = params.get("score", [])
+    for name in names:
+        if name not in scorers:
+            raise ValueError(f"Unknown scorer: {name}")
+    return names
+
+
+class StaleCorpus(Exception):
+    """Raised when a request refers to a previous generation of the corpus"""
+
+
+class Corpus:
+    """
+    A snapshot of all conversations, held in memory along with cached indexes and
+    query results. Never modified once loaded, changes load a new snapshot
+    (see `LiveCorpus`) with the next `generation`.
+    """
+
+    def __init__(
+        self,
+        convos: list[Conversation],
+        cache_size: int = 256,
+        generation: int = 0,
+    ) -> None:
+        self.convos = convos
+        self.generation = generation
+        # per-instance caches, so that they are dropped with the snapshot
+        self.messages = lru_cache(maxsize=32)(self._messages)  # type: ignore
+        self.convo_messages = lru_cache(maxsize=32)(self._convo_messages)  # type: ignore
+        self.query = lru_cache(maxsize=cache_size)(self._query)  # type: ignore
+
+    def _messages(self, glob: str = "*") -> list[Message]:
+        """Messages from conversations matching the glob, in time order"""
+        return list(
+            heapq.merge(
+                *(
+                    convo.messages
+                    for convo in self.convos
+                    if glob == "*" or glob.lower() in convo.title.lower()
+                ),
+                key=lambda m: m.timestamp,
+            )
+        )
+
+    def _convo_messages(self, glob: str = "*") -> list[Message]:
+        """
+        Messages from conversations matching the glob, one conversation after another.
+
+        Same order as `load._load_all_messages`, so that results with ties (and
+        floating-point sums) come out the same as when computed locally.
+        """
+        return [
+            msg
+            for convo in self.convos
+            if glob == "*" or glob.lower() in convo.title.lower()
+            for msg in convo.messages
+        ]
+
+    def _query(self, endpoint: str, params: tuple[tuple[str, tuple[str, ...]], ...]):
+        """Returns the JSON-encoded result of a query"""
+        handler = endpoints[endpoint]
+        result = handler(self, {k: list(v) for k, v in params})
+        return json.dumps(result, default=str).encode("utf8")
+
+    def warm(self) -> None:
+        """Precomputes indexes used by most queries"""
+        self.messages("*")
+        self.convo_messages("*")
+
+
+class LiveCorpus:
+    """Holds the current corpus, replacing it with a new snapshot when chat files change"""
+
+    def __init__(
+        self,
+        corpus: Corpus,
+        cache_size: int = 256,
+        mtimes: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.current = corpus
+        self.cache_size = cache_size
+        # mtimes of the chat files the corpus was loaded from, None if not loaded from disk
+        self.mtimes = mtimes
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cache_size: int = 256) -> "LiveCorpus":
+        mtimes = _chatfile_mtimes()
+        corpus = Corpus(_load_convos(), cache_size=cache_size)
+        return cls(corpus, cache_size=cache_size, mtimes=mtimes)
+
+    def refresh(self) -> Corpus:
+        """
+        Returns the current corpus, first reloading it if any chat file has changed.
+
+        Queries already running on the previous snapshot finish on it, and only ever
+        fill its caches, so they can't leave stale results in the new one.
+        """
+        with self._refresh_lock:
+            if self.mtimes is None:
+                return self.current
+            mtimes = _chatfile_mtimes()
+            if mtimes != self.mtimes:
+                logger.info("Chat files changed, reloading conversations...")
+                # only changed chat files are re-parsed, the rest come from the file cache
+                self.current = Corpus(
+                    _load_convos(),
+                    cache_size=self.cache_size,
+                    generation=self.current.generation + 1,
+                )
+                self.mtimes = mtimes
+            return self.current
+
+
+def _daily(corpus: Corpus, params: Params) -> dict:
+    msgs: list[Message] = corpus.messages(_param(params, "glob", "*"))
+    user = _param(params, "user")
+    return _daily_messaging_stats(_filter_author(msgs, user) if user else msgs)
+
+
+def _yearly(corpus: Corpus, params: Params) -> dict:
+    msgs: list[Message] = corpus.messages(_param(params, "glob", "*"))
+    user = _param(params, "user")
+    return _yearly_messaging_stats(_filter_author(msgs, user) if user else msgs)
+
+
+def _messages(corpus: Corpus, params: Params) -> dict:
+    """
+    Returns a page of matching messages, in time order.
+
+    `next_offset` is the offset to request the next page with, or None if there are no
+    more matches. Offsets index into all messages (not just matches), so that
+    paging through the results is a single pass.
+
+    Offsets are only valid within the same `generation` of the corpus, so requests for
+    later pages should pass the generation returned with the first one.
+    """
+    generation = _param(params, "generation")
+    if generation is not None and int(generation) != corpus.generation:
+        raise StaleCorpus(f"Corpus changed since generation {generation}")
+    msgs: list[Message] = corpus.messages(_param(params, "glob", "*"))
+    user, contains = _param(params, "user"), _param(params, "contains")
+    offset = int(_param(params, "offset", "0"))  # type: ignore
+    limit = min(int(_param(params, "limit", str(page_size))), page_size)  # type: ignore
+
+    page: list[dict] = []
+    next_offset = None
+    for i in range(offset, len(msgs)):
+        if _message_matches(msgs[i], user, contains):
+            page.append(msgs[i].to_dict())
+            if len(page) >= limit:
+                next_offset = i + 1
+                break
+    return {
+        "messages": page,
+        "next_offset": next_offset,
+        "generation": corpus.generation,
+    }
+
+
+endpoints: dict[str, Callable[[Corpus, Params], dict]] = {
+    "daily": _daily,
+    "yearly": _yearly,
+    "top-writers": lambda corpus, params: _top_writers(
+        corpus.convo_messages(_param(params, "glob", "*")), _scores_param(params)
+    ),
+    "people": lambda corpus, params: _people_stats(
+        corpus.convo_messages(_param(params, "glob", "*")), _scores_param(params)
+    ),
+    "connections": lambda corpus, params: _connections_table(
+        _connections(corpus.convo_messages(_param(params, "glob", "*")))
+    ),
+    "most-reacted": lambda corpus, params: {
+        "messages": [
+            msg.to_dict()
+            for msg in _most_reacted_msgs(
+                corpus.convo_messages(_param(params, "glob", "*")),
+                int(_param(params, "limit", "30")),  # type: ignore
+            )
+        ]
+    },
+    "messages": _messages,
+}
+
+# Endpoints with results too large to keep in the result cache
+uncached_endpoints = {"messages"}
+
+
+async def _respond(
+    live: LiveCorpus, method: str, target: str
+) -> tuple[HTTPStatus, bytes]:
+    if method != "GET":
+        return HTTPStatus.METHOD_NOT_ALLOWED, b'{"error": "Only GET is supported"}'
+    url = urlsplit(target)
+    endpoint = url.path.strip("/")
+    if endpoint not in endpoints:
+        body = json.dumps({"error": f"Unknown endpoint: {endpoint}"}).encode("utf8")
+        return HTTPStatus.NOT_FOUND, body
+    params = tuple(sorted((k, tuple(v)) for k, v in parse_qs(url.query).items()))
+    try:
+        # run in threads to keep serving other requests while computing
+        corpus = await asyncio.to_thread(live.refresh)
+        query = corpus._query if endpoint in uncached_endpoints else corpus.query
+        body = await asyncio.to_thread(query, endpoint, params)
+    except StaleCorpus as e:
+        return HTTPStatus.CONFLICT, json.dumps({"error": str(e)}).encode("utf8")
+    except ValueError as e:
+        return HTTPStatus.BAD_REQUEST, json.dumps({"error": str(e)}).encode("utf8")
+    return HTTPStatus.OK, body
+
+
+async def _handle(
+    live: LiveCorpus,
+    allowed_hosts: Optional[set[str]],
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        request_line = (await reader.readline()).decode("latin1")
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            method, target, _ = request_line.split(" ", 2)
+            if allowed_hosts is not None and headers.get("host") not in allowed_hosts:
+                status = HTTPStatus.FORBIDDEN
+                body = b'{"error": "Host not allowed"}'
+            else:
+                status, body = await _respond(live, method, target)
+        except ValueError:
+            status, body = HTTPStatus.BAD_REQUEST, b'{"error": "Bad request"}'
+        except Exception as e:
+            logger.exception(f"Error handling request: {request_line.strip()}")
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            body = json.dumps({"error": str(e)}).encode("utf8")
+        logger.info(f"{request_line.strip()} -> {status.value}")
+        writer.write(
+            (
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin1")
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def _start_server(
+    live: LiveCorpus, host: str, port: int, check_host: bool = True
+) -> asyncio.Server:
+    """
+    Starts the server. Unless `check_host` is False, only requests with a loopback
+    name and the server's port in their Host header are answered.
+    """
+    allowed_hosts: Optional[set[str]] = set() if check_host else None
+    server = await asyncio.start_server(
+        lambda r, w: _handle(live, allowed_hosts, r, w), host=host, port=port
+    )
+    if allowed_hosts is not None:
+        # filled in once bound, since the port may have been picked by the OS
+        port = server.sockets[0].getsockname()[1]
+        allowed_hosts.update(f"{name}:{port}" for name in _loopback_names)
+    return server
+
+
+async def _serve(live: LiveCorpus, host: str, port: int, check_host: bool) -> None:
+    server = await _start_server(live, host, port, check_host)
+    host, port = server.sockets[0].getsockname()[:2]
+    server_file = _server_file()
+    server_file.parent.mkdir(parents=True, exist_ok=True)
+    # written atomically, so clients never read a partial file
+    tmpfile = server_file.with_name(f"{server_file.name}.{os.getpid()}.tmp")
+    tmpfile.write_text(json.dumps({"host": host, "port": port, "pid": os.getpid()}))
+    os.replace(tmpfile, server_file)
+    logger.info(f"Serving on http://{host}:{port}")
+
+    # shut down cleanly on SIGTERM too (not supported on Windows)
+    task = asyncio.current_task()
+    with suppress(NotImplementedError):
+        if task is not None:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        server_file.unlink(missing_ok=True)
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8042,
+    cache_size: int = 256,
+    allow_remote: bool = False,
+) -> None:
+    """
+    Serves the corpus over HTTP. Only loopback addresses are allowed as `host`, unless
+    `allow_remote` is set, which also disables checking the Host header.
+    """
+    if not allow_remote and not _is_loopback(host):
+        raise ValueError(f"Refusing to serve on non-loopback address: {host}")
+    live = LiveCorpus.load(cache_size=cache_size)
+    live.current.warm()
+    try:
+        asyncio.run(_serve(live, host, port, check_host=not allow_remote))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Server stopped")
+
+
+def test_server():
+    from datetime import datetime
+
+    msgs = [
+        Message("A", "B", datetime(2020, 1, 1), "hi", data={"groupchat": False}),
+        Message(
+            "B",
+            "A",
+            datetime(2021, 1, 1),
+            "yo",
+            reactions=[{"reaction": "👍", "actor": "A"}],
+            data={"groupchat": False},
+        ),
+    ]
+    corpus = Corpus([Conversation("B", ["A", "B"], msgs, {"groupchat": False})])
+
+    async def get(port: int, target: str, host: str = "") -> tuple[int, dict]:
+        host = host or f"localhost:{port}"
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        while (await reader.readline()) != b"\r\n":
+            pass
+        body = json.loads(await reader.read())
+        writer.close()
+        return status, body
+
+    async def run() -> None:
+        server = await _start_server(LiveCorpus(corpus), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            status, yearly = await get(port, "/yearly")
+            assert status == 200
+            assert [row[0] for row in yearly["rows"]] == [2020, 2021]
+
+            # concurrent requests
+            results = await asyncio.gather(
+                get(port, "/messages?user=b"),
+                get(port, "/most-reacted"),
+                get(port, "/connections"),
+            )
+            assert all(status == 200 for status, _ in results)
+            found = [Message.from_dict(d) for d in results[0][1]["messages"]]
+            assert found == [msgs[1]]
+
+            # paginated messages
+            status, page = await get(port, "/messages?limit=1")
+            assert [d["content"] for d in page["messages"]] == ["hi"]
+            status, page = await get(port, f"/messages?offset={page['next_offset']}")
+            assert [d["content"] for d in page["messages"]] == ["yo"]
+            assert page["next_offset"] is None
+            assert page["generation"] == 0
+
+            # paging across a reload of the corpus
+            assert (await get(port, "/messages?offset=1&generation=1"))[0] == 409
+
+            assert (await get(port, "/nonexistent"))[0] == 404
+            assert (await get(port, "/people?score=nonexistent"))[0] == 400
+
+            # requests for other hosts (as with DNS rebinding) are refused
+            assert (await get(port, "/yearly", host=f"example.com:{port}"))[0] == 403
+            assert (await get(port, "/yearly", host="localhost:1"))[0] == 403
+            assert (await get(port, "/yearly", host=f"127.0.0.1:{port}"))[0] == 200
+
+    asyncio.run(run())
+    assert _is_loopback("127.0.0.1") and _is_loopback("::1")
+    assert not _is_loopback("0.0.0.0") and not _is_loopback("example.com")
+    # the repeated query was answered from the cache
+    assert corpus.query.cache_info().hits == 1  # type: ignore
+    asyncio.run(asyncio.to_thread(corpus.query, "yearly", ()))
+    assert corpus.query.cache_info().hits == 2  # type: ignore
+    # messages aren't cached
+    assert corpus.query.cache_info().currsize == 3  # type: ignore
+
+
+def test_corpus_refresh(monkeypatch):
+    from datetime import datetime
+
+    def convos(content: str) -> list[Conversation]:
+        msg = Message("A", "B", datetime(2020, 1, 1), content)
+        return [Conversation("B", ["A", "B"], [msg], {"groupchat": False})]
+
+    mtimes = {"message_1.json": 1.0}
+    monkeypatch.setattr(__name__ + "._chatfile_mtimes", lambda: dict(mtimes))
+    monkeypatch.setattr(__name__ + "._load_convos", lambda: convos("old"))
+    live = LiveCorpus.load()
+    old = live.current
+    assert old.query("yearly", ()) == old.query("yearly", ())
+
+    # unchanged files, nothing is reloaded
+    assert live.refresh() is old
+
+    mtimes["message_1.json"] = 2.0
+    monkeypatch.setattr(__name__ + "._load_convos", lambda: convos("new!"))
+    new = live.refresh()
+    assert new is not old and new.generation == old.generation + 1
+    assert new.query.cache_info().currsize == 0  # type: ignore
+    assert new.messages()[0].content == "new!"
+
+    # queries still running on the old snapshot only see (and cache) old results
+    assert old.messages()[0].content == "old"
+    old.query("daily", ())
+    assert new.query.cache_info().currsize == 0  # type: ignore
@@ -0,0 +1,80 @@
+"""
+Per-conversation summaries (members, per-member activity, first/last activity).
+
+Summaries are computed per chat file and cached (see `_cache_by_file`), so commands
+which only need aggregates don't have to load any message bodies.
+"""
+
+import logging
+from pathlib import Path
+from typing import Iterator
+
+from .models import Conversation, ConvoSummary
+from .load import _cache_by_file, _parse_chatfile, _get_all_conv_dirs
+
+logger = logging.getLogger(__name__)
+
+
+def _summarize(convo: Conversation) -> ConvoSummary:
+    summary = ConvoSummary(
+        title=convo.title,
+        participants=convo.participants,
+        groupchat=convo.data["groupchat"],
+    )
+    for msg in convo.messages:
+        summary.messages_by_user[msg.from_name] += 1
+        for react in msg.reactions:
+            summary.reacts_by_user[react["actor"]] += 1
+        summary.days.add(msg.timestamp.date())
+    if convo.messages:
+        # messages are sorted by time
+        summary.first = convo.messages[0].timestamp
+        summary.last = convo.messages[-1].timestamp
+    return summary
+
+
+@_cache_by_file
+def _chatfile_summary(filename: Path) -> ConvoSummary:
+    return _summarize(_parse_chatfile(filename))
+
+
+def _load_summary(convdir: Path) -> ConvoSummary:
+    summary = None
+    for file in sorted(convdir.glob("message_*.json")):
+        s = _chatfile_summary(file)
+        summary = s if summary is None else summary.merge(s)
+    assert summary is not None
+    return summary
+
+
+def _load_summaries(glob: str = "*") -> Iterator[ConvoSummary]:
+    logger.info("Loading conversation summaries...")
+    for convdir in _get_all_conv_dirs():
+        summary = _load_summary(convdir)
+        if glob == "*" or glob.lower() in summary.title.lower():
+            yield summary
+
+
+def test_summarize():
+    from datetime import datetime
+    from .models import Message
+
+    msgs = [
+        Message("A", "G", datetime(2020, 1, 1), "hi", reactions=[{"actor": "B"}]),
+        Message("A", "G", datetime(2020, 1, 1, 12), "anyone?"),
+        Message("B", "G", datetime(2020, 2, 1), "yes"),
+    ]
+    convo = Conversation("G", ["A", "B", "C"], msgs, {"groupchat": True})
+    summary = _summarize(convo)
+    assert summary.messages_by_user == {"A": 2, "B": 1}
+    assert summary.reacts_by_user == {"B": 1}
+    assert summary.n_messages == 3
+    assert len(summary.days) == 2
+    assert summary.first == datetime(2020, 1, 1)
+    assert summary.last == datetime(2020, 2, 1)
+
+    empty = _summarize(Conversation("G", ["A", "B", "C"], [], {"groupchat": True}))
+    merged = empty.merge(summary)
+    assert merged.n_messages == 3
+    assert merged.first == summary.first
+    assert merged.last == summary.last
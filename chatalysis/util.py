@@ -1,5 +1,6 @@
 import re
-from typing import List, Dict, Iterator, Counter as TCounter
+import hashlib
+from typing import List, Dict, Iterable, Iterator, Counter as TCounter
 from datetime import timedelta, date
 from itertools import groupby
 from collections import Counter, defaultdict
@@ -34,13 +35,16 @@ def _count_emoji(txt: str) -> Dict[str, int]:
     return {k: len(list(v)) for k, v in groupby(sorted(re_emoji.findall(txt)))}
 
 
-def _format_emojicount(emojicount: Dict[str, int]):
+def _format_counts(counts: Dict[str, int]) -> str:
     return ", ".join(
-        f"{n}x {emoji}"
-        for n, emoji in reversed(sorted((v, k) for k, v in emojicount.items()))
+        f"{n}x {k}" for n, k in reversed(sorted((v, k) for k, v in counts.items()))
     )
 
 
+def _format_emojicount(emojicount: Dict[str, int]):
+    return _format_counts(emojicount)
+
+
 def test_count_emoji() -> None:
     # assert _count_emoji("\u00e2\u009d\u00a4") == {"\u00e2\u009d\u00a4": 1}
     assert _count_emoji("👍👍😋😋❤") == {"👍": 2, "😋": 2, "❤": 1}
@@ -74,9 +78,15 @@ def _calendar(msgs: List[Message]) -> Dict[date, List[Message]]:
     return msgs_per_date
 
 
-def _filter_author(msgs: list[Message], name: str) -> list[Message]:
-    return [m for m in msgs if name in m.from_name]
+def _filter_author(msgs: Iterable[Message], name: str) -> Iterator[Message]:
+    return (m for m in msgs if name in m.from_name)
 
 
 def _active_days(msgs: list[Message]) -> set[date]:
     return {m.timestamp.date() for m in msgs}
+
+
+def _message_key(m: Message) -> str:
+    # Stable identity of a message, used to key persisted per-message data
+    ident = "\0".join((m.from_name, m.to_name, m.timestamp.isoformat(), m.content))
+    return hashlib.sha1(ident.encode("utf8")).hexdigest()